@@ -78,13 +78,28 @@ class BoolODE(object):
             data['icsPath'] = Path(self.global_settings.model_dir, job.get('model_initial_conditions',''))
             data['num_cells'] = job.get('num_cells',100)
             data['sample_cells'] = job.get('sample_cells',False)
+            data['global_seed'] = job.get('global_seed',0)
             data['nClusters'] = job.get('nClusters',1)
+            data['cluster_method'] = job.get('cluster_method','minibatch')
+            data['cluster_quantize'] = job.get('cluster_quantize',False)
+            data['cluster_n_init'] = job.get('cluster_n_init',None)
+            data['cluster_max_iter'] = job.get('cluster_max_iter',100)
             data['doParallel'] = job.get('do_parallel',False)    
             print(f"doParallel={data['doParallel']}")        
             data['identical_pars'] = job.get('identical_pars',False)
             data['sample_pars'] = job.get('sample_pars',False)
             data['sample_std'] = job.get('sample_std',0.1)
             data['integration_step_size'] = job.get('integration_step_size',0.01)            
+            data['simulation_format'] = job.get('simulation_format','csv')
+            # Checked here, before any job is simulated
+            if data['simulation_format'] not in ('csv','parquet','none'):
+                raise ValueError("simulation_format of job " + str(data['name'])
+                                 + " should be one of 'csv', 'parquet' or 'none', got '"
+                                 + str(data['simulation_format']) + "'")
+            if data['simulation_format'] == 'none' and self.global_settings.do_post_processing:
+                raise ValueError("simulation_format of job " + str(data['name'])
+                                 + " is 'none', but post processing requires the simulated"
+                                 " trajectories. Use 'csv' or 'parquet', or set do_post_processing to False")
             # Optional Settings
             data['parameter_inputs_path'] = Path(self.global_settings.model_dir,\
                                                  job.get('parameter_inputs_path',''))
@@ -172,6 +187,7 @@ class BoolODE(object):
                     settings['nDatasets'] = gsamp.get('nDatasets', 1)
                     settings['name'] = self.jobs[jobid]['name']
                     settings['nClusters'] = self.jobs[jobid]['nClusters']
+                    settings['simulation_format'] = self.jobs[jobid]['simulation_format']
                     generatedPaths[jobid] = po.genSamples(settings)
         
         if self.post_settings.dropout_jobs is not None:
@@ -58,6 +58,9 @@ class GenerateModel:
         self.varmapper = dict()
         self.par = dict()
         self.parmapper = dict()
+        self.parNames = tuple()
+        self.parValues = np.array([])
+        self.parIdx = dict()
         self.kineticParameterDefaults = dict()
         self.inputs = list()
         self.genelist = list()
@@ -65,6 +68,11 @@ class GenerateModel:
         self.nodeTypeDF = pd.DataFrame()
         self.df = pd.DataFrame()
         self.ModelSpec = dict()
+        self.rnaIndex = np.array([], dtype=np.int64)
+        self.proteinIndex = np.array([], dtype=np.int64)
+        self.revvarmapper = dict()
+        self.y0 = np.array([])
+        self.ss_default = np.array([])
         self.path_to_ode_model = str()
         # Read the model definition
         # 1. populate self.df
@@ -75,6 +83,8 @@ class GenerateModel:
         self.getParameters()
         # Create the model dictionary
         self.generateModelDict()
+        # Store variable indices and default initial values
+        self.createVariableIndices()
         # Write ODE model to file
         self.writeModelToFile()
         # Write parameters to file
@@ -580,43 +590,93 @@ class GenerateModel:
         
         self.varmapper = {i:var for i,var in enumerate(self.ModelSpec['varspecs'].keys())}
         self.parmapper = {i:par for i,par in enumerate(self.ModelSpec['pars'].keys())}
+        # Parameter names sorted in the order expected by the model
+        # function, with the corresponding values as a float64 array
+        self.parNames = tuple(sorted(self.ModelSpec['pars']))
+        self.parValues = np.array([self.ModelSpec['pars'][k] for k in self.parNames],
+                                  dtype=np.float64)
+        self.parIdx = {n:i for i,n in enumerate(self.parNames)}
+
+    def createVariableIndices(self):
+        """
+        Stores the quantities that only depend on the variables of the model,
+        so that they are computed once instead of for every experiment:
+
+        1. rnaIndex, proteinIndex - indices of the gene (x_) and protein (p_) variables, as integer arrays
+        2. revvarmapper - Mapper: {variable name : index}
+        3. y0 - initial values of the variables in ModelSpec['ics']
+        4. ss_default - default values used to compute the initial conditions of a simulation
+        """
+        numvars = len(self.varmapper.keys())
+        self.rnaIndex = np.asarray([i for i in range(numvars) if 'x_' in self.varmapper[i]],
+                                   dtype=np.int64)
+        self.proteinIndex = np.asarray([i for i in range(numvars) if 'p_' in self.varmapper[i]],
+                                       dtype=np.int64)
+        self.revvarmapper = {v:k for k,v in self.varmapper.items()}
+        self.y0 = np.asarray([self.ModelSpec['ics'][self.varmapper[i]] for i in range(numvars)],
+                             dtype=np.float64)
+        self.ss_default = np.zeros(numvars)
+        for i,k in self.varmapper.items():
+            if 'x_' in k:
+                self.ss_default[i] = 1.0
+            elif 'p_' in k:
+                if k.replace('p_','') in self.proteinlist:
+                    # Seting them to the threshold
+                    # causes them to drop to 0 rapidly
+                    # TODO: try setting to threshold < v < y_max
+                    self.ss_default[i] = 20.
 
     def writeModelToFile(self):
         """
         Writes model to file as a python function.
         The ODE model generated using generateModelDict() is defined as 
-        a python ODE function called Model(). Model() takes 3 arguments:
+        a numba compiled function called ModelRHS(). ModelRHS() takes 4 arguments:
 
         1. The current model state vector Y
         2. The current time t
-        3. A list of parameters pars
-
-        The function returns a vector of time derivatives computed from the ODEs.
+        3. An array of parameters pars
+        4. The output vector dY
+
+        The function writes the vector of time derivatives computed from the ODEs
+        into dY. Two wrappers are written alongside it: Model(Y,t,pars), which
+        returns a new array of derivatives, and compileModelLSODA(), which compiles
+        and returns a numba cfunc with the signature expected by numbalsoda.
+        The cfunc is only compiled when called, i.e. for ODE simulations.
         Model() is written model.py in the directory of the current job
         """
         self.path_to_ode_model = self.settings['outprefix'] / 'model.py'
+        numvars = str(len(self.varmapper.keys()))
+        numpars = str(len(self.parNames))
 
         with open(self.path_to_ode_model,'w') as out:
             out.write('#####################################################\n')
             out.write('import numpy as np\n')
+            out.write('from numba import njit, cfunc, carray\n')
             out.write('# This file is created automatically\n')
-            out.write('def Model(Y,t,pars):\n')
+            out.write('@njit(fastmath=True)\n')
+            out.write('def ModelRHS(Y,t,pars,dY):\n')
             out.write('    # Parameters\n')
-            par_names = sorted(self.ModelSpec['pars'].keys())
-            for i,p in enumerate(par_names):
+            for i,p in enumerate(self.parNames):
                 out.write('    ' + p + ' = pars[' + str(i) + ']\n')
-            outstr = ''
             out.write('    # Variables\n')
             for i in range(len(self.varmapper.keys())):
                 out.write('    ' + self.varmapper[i] + ' = Y[' + str(i) + ']\n')
-                outstr += 'd' + self.varmapper[i] + ','
             for i in range(len(self.varmapper.keys())):
                 vdef = self.ModelSpec['varspecs'][self.varmapper[i]]
                 vdef = vdef.replace('^','**')
-                out.write('    d' + self.varmapper[i] + ' = '+vdef+'\n')
-
-            out.write('    dY = np.array([' + outstr+ '])\n')
+                out.write('    dY[' + str(i) + '] = '+vdef+'\n')
+            out.write('\n')
+            out.write('def Model(Y,t,pars):\n')
+            out.write('    dY = np.empty(' + numvars + ')\n')
+            out.write('    ModelRHS(np.asarray(Y, dtype=np.float64),t,np.asarray(pars, dtype=np.float64),dY)\n')
             out.write('    return(dY)\n')
+            out.write('\n')
+            out.write('def compileModelLSODA():\n')
+            out.write('    from numbalsoda import lsoda_sig\n')
+            out.write('    @cfunc(lsoda_sig)\n')
+            out.write('    def ModelLSODA(t,Y,dY,pars):\n')
+            out.write('        ModelRHS(carray(Y,(' + numvars + ',)),t,carray(pars,(' + numpars + ',)),carray(dY,(' + numvars + ',)))\n')
+            out.write('    return(ModelLSODA)\n')
             out.write('#####################################################')
 
     
@@ -1,11 +1,14 @@
 import os
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from pathlib import Path
 from sklearn.cluster import KMeans
 from sklearn.manifold import TSNE
 import matplotlib.pyplot as plt
+# local imports
+from BoolODE import utils
 
 def genSamples(opts):
     """
@@ -14,6 +17,11 @@ def genSamples(opts):
     """
     numclusters = opts['nClusters']
     num_simulations = opts['num_cells']
+    simulationFormat = opts.get('simulation_format', 'csv')
+    if simulationFormat == 'none':
+        raise ValueError("GenSamples requires the simulated trajectories, "
+                         "set simulation_format to 'csv' or 'parquet' for job "
+                         + str(opts['name']))
     
     if numclusters > 1:
         clusterdf = pd.read_csv(opts['outPrefix'] + '/ClusterIds.csv', index_col=0)
@@ -23,7 +31,8 @@ def genSamples(opts):
         print('sample_size should be less than num of experiments')
         sample_size = num_simulations
         
-    df = pd.read_csv(opts['outPrefix'] + '/simulations/E0.csv',index_col=0)
+    df = utils.readSimulation(opts['outPrefix'] + '/simulations/E0',
+                                simulationFormat)
     maxtime = len(df.columns)
 
     generatedPaths = []
@@ -38,19 +47,24 @@ def genSamples(opts):
             os.makedirs(outfpath)
         # Create cell ids
         simids = np.random.choice(range(num_simulations), size=sample_size, replace=False)
-        fids = ['E'+ str(sid) + '.csv' for sid in simids]            
+        fids = ['E'+ str(sid) for sid in simids]            
         timepoints = np.random.choice(range(1,maxtime), size=sample_size)
         min_t = min(timepoints)
         max_t = max(timepoints)
         pts = [(t - min_t)/(max_t - min_t) for t in timepoints]
         cellids = ['E' + str(sid) + '_' + str(t) for sid, t in zip(simids, timepoints)] 
         # Read simulations from input dataset #psetid
-        # to build a sample
-        sample = []
-        for fid, cid in tqdm(zip(fids, cellids)):
-            df = pd.read_csv( opts['outPrefix'] + '/simulations/' + fid, index_col=0)
+        # to build a sample. The files are parsed in parallel threads,
+        # pandas releases the GIL while parsing.
+        def readCell(fidcid):
+            fid, cid = fidcid
+            df = utils.readSimulation(opts['outPrefix'] + '/simulations/' + fid,
+                                      simulationFormat)
             df.sort_index(inplace=True)
-            sample.append(df[cid].to_frame())
+            return(df[cid].to_frame())
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as ex:
+            sample = list(tqdm(ex.map(readCell, zip(fids, cellids)),
+                               total=len(fids)))
         sampledf = pd.concat(sample,axis=1)
         sampledf.to_csv(outfpath + '/ExpressionData.csv')
         ## Read refNetwork.csv
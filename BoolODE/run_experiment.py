@@ -13,7 +13,13 @@ from pathlib import Path
 from optparse import OptionParser
 from itertools import combinations
 from scipy.integrate import odeint
-from sklearn.cluster import KMeans
+# Use the Intel extension for scikit-learn (faster KMeans) if it is installed
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+except ImportError:
+    pass
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from importlib.machinery import SourceFileLoader
 import multiprocessing as mp
 # local imports
@@ -23,12 +29,18 @@ from BoolODE import simulator
 
 np.seterr(all='raise')
 
+## Arguments shared by every simulation in a worker process,
+## set once per worker by initWorker()
+workerArgs = {}
+
 def Experiment(mg, Model,
                tspan,
                settings,
                icsDF,
                writeProtein=False,
-               normalizeTrajectory=False):
+               normalizeTrajectory=False,
+               isStochastic=True,
+               funcptr=None):
     """
     Carry out an `in-silico` experiment. This function takes as input 
     an ODE model defined as a python function and carries out stochastic
@@ -42,7 +54,7 @@ def Experiment(mg, Model,
 
     :param mg: Model details obtained by instantiating an object of GenerateModel
     :type mg: BoolODE.GenerateModel
-    :param Model: Function defining ODE model
+    :param Model: numba compiled function defining ODE model
     :type Model: function
     :param tspan: Array of time points
     :type tspan: ndarray
@@ -54,29 +66,22 @@ def Experiment(mg, Model,
     :type writeProtein: bool
     :param normalizeTrajectory: Bool specifying if the gene expression values should be scaled between 0 and 1.
     :type normalizeTrajectory: bool 
+    :param isStochastic: Bool specifying if SDE simulations are performed. If False, ODE simulations are performed instead. Default = True
+    :type isStochastic: bool
+    :param funcptr: Address of the ODE model compiled for numbalsoda, required if isStochastic is False
+    :type funcptr: int
     """
     ####################
-    allParameters = dict(mg.ModelSpec['pars'])
-    parNames = sorted(list(allParameters.keys()))
     ## Use default parameters 
-    pars = [mg.ModelSpec['pars'][k] for k in parNames]
+    pars = mg.parValues
     ####################
-    rnaIndex = [i for i in range(len(mg.varmapper.keys())) if 'x_' in mg.varmapper[i]]
-    revvarmapper = {v:k for k,v in mg.varmapper.items()}
-    proteinIndex = [i for i in range(len(mg.varmapper.keys())) if 'p_' in mg.varmapper[i]]
+    rnaIndex = mg.rnaIndex
+    revvarmapper = mg.revvarmapper
+    proteinIndex = mg.proteinIndex
 
-    y0 = [mg.ModelSpec['ics'][mg.varmapper[i]] for i in range(len(mg.varmapper.keys()))]
-    ss = np.zeros(len(mg.varmapper.keys()))
-    
-    for i,k in mg.varmapper.items():
-        if 'x_' in k:
-            ss[i] = 1.0
-        elif 'p_' in k:
-            if k.replace('p_','') in mg.proteinlist:
-                # Seting them to the threshold
-                # causes them to drop to 0 rapidly
-                # TODO: try setting to threshold < v < y_max
-                ss[i] = 20.
+    y0 = mg.y0
+    # ss is modified below, keep the model defaults intact
+    ss = mg.ss_default.copy()
             
     if not icsDF.empty:
         icsspec = icsDF.loc[0]
@@ -105,22 +110,22 @@ def Experiment(mg, Model,
 
     n_snapshots = settings.get('n_snapshots', 0)
         
-    # Index of every possible time point. Sample from this list
+    # First time point that a cell can be sampled from
     startat = 0
-    timeIndex = [i for i in range(startat, len(tspan))]        
 
     ## Construct dictionary of arguments to be passed
     ## to simulateAndSample(), done in parallel
     outPrefix = str(settings['outprefix'])
     argdict = {}
     argdict['mg'] = mg
-    argdict['allParameters'] = allParameters
-    argdict['parNames'] = parNames
     argdict['Model'] = Model
+    argdict['funcptr'] = funcptr
+    argdict['isStochastic'] = isStochastic
     argdict['tspan'] = tspan
     argdict['varmapper'] = mg.varmapper
-    argdict['timeIndex'] = timeIndex
     argdict['genelist'] = mg.genelist
+    # Built once and shared by the DataFrames of every cell
+    argdict['geneIndex'] = pd.Index(mg.genelist, dtype=object)
     argdict['proteinlist'] = mg.proteinlist
     argdict['writeProtein'] = writeProtein
     argdict['outPrefix'] = outPrefix
@@ -133,20 +138,32 @@ def Experiment(mg, Model,
     argdict['revvarmapper'] = revvarmapper
     argdict['x_max'] = mg.kineticParameterDefaults['x_max']
     argdict['n_snapshots'] = n_snapshots
+    argdict['simulationFormat'] = settings['simulation_format']
 
     if settings['sample_cells']:
         # pre-define the time points from which a cell will be sampled
         # per simulation
-        sampleAt = np.random.choice(timeIndex, size=settings['num_cells'])
+        rng = np.random.RandomState(settings['global_seed'])
+        sampleAt = rng.randint(startat, len(tspan),
+                               size=settings['num_cells'], dtype=np.int64)
         header = ['E' + str(cellid) + '_' + str(time) \
                   for cellid, time in\
                   zip(range(settings['num_cells']), sampleAt)]
         
         argdict['header'] = header
-    else:
-        # initialize dictionary to hold raveled values, used to cluster
-        # This will be useful later.
-        groupedDict = {}         
+        argdict['sampleAt'] = sampleAt
+        # Variables written for each sampled cell: all of them
+        # if writeProtein, else only the genes
+        if writeProtein:
+            sampleRows = np.arange(len(mg.varmapper.keys()))
+        else:
+            sampleRows = rnaIndex
+        argdict['sampleRows'] = sampleRows
+        argdict['sampleIndex'] = pd.Index([mg.varmapper[i] for i in sampleRows])
+
+    # initialize dictionary to hold raveled values, used to cluster
+    # This will be useful later.
+    groupedDict = {}
 
     simfilepath = Path(outPrefix, './simulations/')
     if not os.path.exists(simfilepath):
@@ -154,66 +171,119 @@ def Experiment(mg, Model,
         os.makedirs(simfilepath)
 
     print('n_snapshots =', n_snapshots)
+    # Compile the integrator once, so that the worker processes
+    # inherit the compiled code instead of each compiling it again
+    simulator.simulateModel(Model, y0, pars, isStochastic, tspan[:2], 0,
+                            funcptr=funcptr,
+                            checkIndex=rnaIndex, threshold=0.1*mg.kineticParameterDefaults['x_max'])
     print('Starting simulations...')
 
     start = time.time()
 
+    # Every simulation shares the same (sorted) gene index and the same
+    # number of sampled time points, so the output is written directly
+    # into a single array of genes x (num_cells * time points)
+    geneOrder = np.argsort(mg.genelist)
+    # Column name suffixes of the sampled time points, shared by all
+    # cells. The column names are E<cellid><suffix>
+    if n_snapshots == 0:
+        # We skip the first time index for historical reasons: tps = [1..end]
+        timeSuffixes = [f'_{t}' for t in range(1, len(tspan))]
+    else:
+        timeSuffixes = [f'_t{i}' for i in range(n_snapshots)]
+    ncols = len(timeSuffixes)
+    resultShape = (len(mg.genelist), settings['num_cells']*ncols)
+    argdict['geneOrder'] = geneOrder
+    argdict['timeSuffixes'] = timeSuffixes
+
     print('parallelize =', settings['doParallel'])
+    resultArr = np.empty(resultShape)
     if settings['doParallel']:
-        with mp.Pool() as pool:
-            jobs = []
-            for cellid in range(settings['num_cells']):
-                #print(f'Simulating cell {cellid}...')
-                cell_args = dict(argdict, seed=cellid, cellid=cellid)
-                job = pool.apply_async(simulateAndSample, args=(cell_args,))
-                jobs.append(job)
-                
-            for job in jobs:
-                job.get()
+        # With fork, the workers inherit the compiled model and argdict
+        # without pickling them
+        if 'fork' in mp.get_all_start_methods():
+            ctx = mp.get_context('fork')
+        else:
+            ctx = mp.get_context()
+        # argdict is sent once to each worker instead of once per cell,
+        # and each task simulates a contiguous range of cells
+        poolSize = mp.cpu_count()
+        bounds = np.linspace(0, settings['num_cells'],
+                             min(settings['num_cells'], poolSize*4) + 1).astype(int)
+        cellRanges = [(s, e) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+        with ctx.Pool(processes=poolSize, initializer=initWorker,
+                      initargs=(argdict,)) as pool:
+            # Each block is copied into place as soon as it is
+            # returned, so the blocks are not all kept in memory
+            for start, end, block in pool.imap_unordered(simulateCellRange,
+                                                         cellRanges):
+                resultArr[:, start*ncols:end*ncols] = block
     else:
         for cellid in tqdm(range(settings['num_cells'])):
             print(f'Simulating cell {cellid}...')
             argdict['seed'] = cellid
             argdict['cellid'] = cellid
-            simulateAndSample(argdict)
+            _, subset = simulateAndSample(argdict)
+            resultArr[:, cellid*ncols:(cellid + 1)*ncols] = subset[geneOrder, :]
 
     print("Simulations took %0.3f s"%(time.time() - start))
-    frames = []
-    print('starting to concat files')
+    print('starting to concat simulations')
     start = time.time()
 
-    for cellid in range(settings['num_cells']):
-        csvPath = f'{outPrefix}/simulations/E{cellid}.csv'
-        df = pd.read_csv(csvPath, index_col=0)
-        df = df.sort_index()
-
-        # In the standard, older workflow, we do a single timepoint -> we store raveled data for clustering
-        # But if n_snapshots>0, we might have multiple columns from each cell.
-        if n_snapshots == 0:
-            groupedDict[f'E{cellid}'] = df.values.ravel()
-
-        frames.append(df.T)  # store transposed for final concat
+    # In the standard, older workflow, we do a single timepoint -> we store raveled data for clustering
+    # But if n_snapshots>0, we might have multiple columns from each cell.
+    # The features are only needed if the simulations are clustered
+    if settings['nClusters'] > 1 and n_snapshots == 0:
+        if settings['cluster_quantize']:
+            # Expression values can exceed x_max, bin up to the observed maximum
+            quantScale = 255./max(resultArr.max(), np.finfo(np.float32).tiny)
+        for cellid in range(settings['num_cells']):
+            features = resultArr[:, cellid*ncols:(cellid + 1)*ncols].astype(np.float32).ravel()
+            if settings['cluster_quantize']:
+                # Uniformly bin the expression values in [0, max] to 8 bits
+                features = np.clip(np.rint(features*quantScale), 0, 255).astype(np.uint8)
+            groupedDict[f'E{cellid}'] = features
+
+    columns = [f'E{cellid}{suffix}' for cellid in range(settings['num_cells'])
+               for suffix in timeSuffixes]
 
     stop = time.time()
-    print("Concating files took %.2f s" %(stop-start))
-    result = pd.concat(frames,axis=0)
-    result = result.T
-    indices = result.index
-    newindices = [i.replace('x_','') for i in indices]
-    result.index = pd.Index(newindices)
+    print("Concating simulations took %.2f s" %(stop-start))
+    newindices = [mg.genelist[i].replace('x_','') for i in geneOrder]
+    result = pd.DataFrame(resultArr, index=pd.Index(newindices), columns=columns)
     
     if settings['nClusters'] > 1 and n_snapshots == 0:
         ## Carry out k-means clustering to identify which
         ## trajectory a simulation belongs to
         print('Starting k-means clustering')
-        groupedDF = pd.DataFrame.from_dict(groupedDict)
+        # One row of raveled expression values per simulation
+        clusterIds = list(groupedDict)
+        X = np.stack([groupedDict[k] for k in clusterIds]).astype(np.float32, copy=False)
         print('Clustering simulations...')
         start = time.time()            
         # Find clusters in the experiments
-        clusterLabels= KMeans(n_clusters=settings['nClusters']).fit(groupedDF.T.values).labels_
+        # k-means++ seeding makes a single (KMeans) or a few (MiniBatchKMeans)
+        # initializations sufficient, instead of the default 10
+        if settings['cluster_method'] == 'kmeans':
+            clusterer = KMeans(n_clusters=settings['nClusters'],
+                               init='k-means++',
+                               n_init=settings['cluster_n_init'] or 1,
+                               algorithm='elkan',
+                               max_iter=settings['cluster_max_iter'],
+                               tol=1e-3,
+                               random_state=0)
+        else:
+            clusterer = MiniBatchKMeans(n_clusters=settings['nClusters'],
+                                        init='k-means++',
+                                        batch_size=min(4096, X.shape[0]),
+                                        n_init=settings['cluster_n_init'] or 3,
+                                        max_iter=settings['cluster_max_iter'],
+                                        max_no_improvement=10,
+                                        random_state=0)
+        clusterLabels = clusterer.fit(X).labels_
         print('Clustering took %0.3fs' % (time.time() - start))
-        clusterDF = pd.DataFrame(data=clusterLabels, index =\
-                                 groupedDF.columns, columns=['cl'])
+        clusterDF = pd.DataFrame(data=clusterLabels, index=clusterIds,
+                                 columns=['cl'])
         clusterDF.to_csv(outPrefix + '/ClusterIds.csv')
     else:
         print(f'nClusters={settings.get("nClusters",1)} or n_snapshots={n_snapshots}, skipping k-means')
@@ -250,7 +320,10 @@ def startRun(settings):
     # Simulator settings
     tmax = settings['simulation_time']    
     integration_step_size = settings['integration_step_size']
-    tspan = np.linspace(0,tmax,int(tmax/integration_step_size))
+    # Number of points such that consecutive time points are exactly
+    # integration_step_size apart, including both 0 and tmax
+    nsteps = int(round(tmax/integration_step_size)) + 1
+    tspan = np.linspace(0.0, tmax, nsteps, dtype=np.float64)
 
     print(settings)
 
@@ -264,13 +337,20 @@ def startRun(settings):
     # Load the ODE model file
     model = SourceFileLoader("model", mg.path_to_ode_model.as_posix()).load_module()
 
+    # Retained for debugging
+    isStochastic = True
+    # The numbalsoda version of the model is only compiled for ODE simulations
+    funcptr = None if isStochastic else model.compileModelLSODA().address
+
     ## Function call - do the in silico experiment
-    resultDF = Experiment(mg, model.Model,
+    resultDF = Experiment(mg, model.ModelRHS,
                           tspan,
                           settings,
                           icsDF,
                           writeProtein=settings['writeProtein'],
-                          normalizeTrajectory=settings['normalizeTrajectory'])
+                          normalizeTrajectory=settings['normalizeTrajectory'],
+                          isStochastic=isStochastic,
+                          funcptr=funcptr)
     
     # Write simulation output. Creates ground truth files.
     print('Generating input files for pipline...')
@@ -285,18 +365,52 @@ def startRun(settings):
     print('Input file generation took %0.2f s' % (time.time() - start))
     print("BoolODE.py took %0.2fs"% (time.time() - startfull))
 
+def initWorker(argdict):
+    """
+    Pool initializer. Stores the arguments shared by all
+    simulations in the worker process.
+    """
+    workerArgs.update(argdict)
+
+def simulateCellRange(cellRange):
+    """
+    Simulates the cells start, ..., end-1 in a worker process, using the
+    arguments stored by initWorker().
+    Returns start, end and the simulated values of the cells
+    (genes x (end-start)*time points), laid out as the
+    corresponding columns of the output array.
+
+    :param cellRange: (start, end) cell ids
+    :type cellRange: tuple
+    """
+    start, end = cellRange
+    argdict = dict(workerArgs)
+    geneOrder = workerArgs['geneOrder']
+    ncols = len(workerArgs['timeSuffixes'])
+    block = np.empty((len(geneOrder), (end - start)*ncols))
+    for cellid in range(start, end):
+        argdict['seed'] = cellid
+        argdict['cellid'] = cellid
+        _, subset = simulateAndSample(argdict)
+        i = cellid - start
+        block[:, i*ncols:(i + 1)*ncols] = subset[geneOrder, :]
+    return start, end, block
+
 def simulateAndSample(argdict):
     """
     Handles parallelization of ODE simulations.
     Calls the simulator with simulation settings.
+    Returns the cell id and the array of sampled gene expression
+    values (genes x time points).
+    Depending on `simulationFormat`, the values are also written to
+    simulations/E<cellid>.csv ('csv'), simulations/E<cellid>.parquet
+    ('parquet'), or not written at all ('none').
     """
     mg = argdict['mg']
-    allParameters = argdict['allParameters']
-    parNames = argdict['parNames']
     Model = argdict['Model']
+    funcptr = argdict['funcptr']
     tspan = argdict['tspan']
     varmapper = argdict['varmapper']
-    timeIndex = argdict['timeIndex']
     genelist = argdict['genelist']
     proteinlist = argdict['proteinlist']
     writeProtein=argdict['writeProtein']
@@ -313,19 +427,15 @@ def simulateAndSample(argdict):
     seed = argdict['seed']
     pars = argdict['pars']
     x_max = argdict['x_max']
+    simulationFormat = argdict['simulationFormat']
+    geneIndex = argdict['geneIndex']
     
-    # Retained for debugging
-    isStochastic = True
+    isStochastic = argdict['isStochastic']
 
     n_snapshots = argdict.get('n_snapshots', 0)
     
     if sampleCells:
         header = argdict['header']
-        
-    pars = {}
-    for k, v in allParameters.items():
-        pars[k] = v
-    pars = [pars[k] for k in parNames]
     
     ## Boolean to check if a simulation is going to a
     ## 0 steady state, with all genes/proteins dying out
@@ -347,41 +457,34 @@ def simulateAndSample(argdict):
                                      genelist, proteinlist,
                                      varmapper,revvarmapper)
         
-        P = simulator.simulateModel(Model, y0_exp, pars, isStochastic, tspan, seed)
-        P = P.T
-        retry = False
         # 3) Check if everything died
         ## If the largest value of a protein achieved in a simulation is
         ## less than 10% of the y_max, drop the simulation.
         ## This check stems from the observation that in some simulations,
         ## all genes go to the 0 steady state in some rare simulations.
-        maxExp = P[rnaIndex, :].max()
-        if maxExp < 0.1 * x_max:
-            retry = True
+        ## The check is done by the integrator while it runs.
+        P, ok = simulator.simulateModel(Model, y0_exp, pars, isStochastic, tspan, seed,
+                                        funcptr=funcptr,
+                                        checkIndex=rnaIndex, threshold=0.1*x_max)
+        retry = not ok
         tries += 1
+    P = P.T
     print("done")
 
     # If n_snapshots == 0, keep old approach: single-time approach
     if n_snapshots == 0:
         # We skip the first time index for historical reasons: tps = [1..end]
-        timePoints = list(range(1, P.shape[1]))
-        subset = P[rnaIndex, :][:, timePoints]
-        colNames = [f'E{cellid}_{t}' for t in timePoints]
-        df = pd.DataFrame(subset, index=genelist, columns=colNames)
+        subset = P[rnaIndex, 1:]
         if sampleCells:
             ## Write a single cell to file
             ## These samples allow for quickly and
             ## reproducibly testing the output.
-            sampledf = utils.sampleCellFromTraj(cellid,
-                                            tspan, 
-                                            P,
-                                            varmapper, timeIndex,
-                                            genelist, proteinlist,
-                                            header,
-                                            writeProtein=writeProtein)
-            sampledf = sampledf.T
-            sampledf.to_csv(outPrefix + 'E' + str(cellid) + '-cell.csv')            
-            
+            timepoint = argdict['sampleAt'][cellid]
+            sample = P[argdict['sampleRows'], timepoint]
+            sampledf = pd.DataFrame(sample.reshape(-1, 1),
+                                    index=argdict['sampleIndex'],
+                                    columns=[header[cellid]])
+            sampledf.to_csv(os.path.join(outPrefix, 'E' + str(cellid) + '-cell.csv'))
 
     else:
         # n_snapshots > 0: pick snapshots evenly across entire trajectory
@@ -390,6 +493,9 @@ def simulateAndSample(argdict):
         steps = P.shape[1] - 1
         # snapshots indices are random between the indices
         snapshotIndicesLimits = np.round(np.linspace(0, steps, n_snapshots + 1)).astype(int)
+        # The simulation no longer draws from numpy's global random
+        # state, so seed it here for reproducible snapshots per cell
+        np.random.seed(seed)
         # Randomly select one timepoint in each snapshot interval
         snapshotIndices = [np.random.randint(snapshotIndicesLimits[i], snapshotIndicesLimits[i+1])
                        for i in range(n_snapshots)]
@@ -397,15 +503,23 @@ def simulateAndSample(argdict):
         
         print(f"Cell {cellid} snapshot indices:", snapshotIndices)
 
-        colNames = [f'E{cellid}_t{i}' for i in range(n_snapshots)]
-        subset = P[rnaIndex, :][:, snapshotIndices]
-        df = pd.DataFrame(subset, index=genelist, columns=colNames)
-
-    # 4) Save to CSV
-    df.to_csv(os.path.join(outPrefix, f'E{cellid}.csv'))
+        subset = P[np.ix_(rnaIndex, snapshotIndices)]
+
+    # 4) Save to file
+    if simulationFormat != 'none':
+        colNames = [f'E{cellid}{suffix}' for suffix in argdict['timeSuffixes']]
+    if simulationFormat == 'csv':
+        df = pd.DataFrame(subset, index=geneIndex, columns=colNames, copy=False)
+        df.to_csv(os.path.join(outPrefix, f'E{cellid}.csv'))
+    elif simulationFormat == 'parquet':
+        df = pd.DataFrame(subset, index=geneIndex, columns=colNames, copy=False)
+        df.to_parquet(os.path.join(outPrefix, f'E{cellid}.parquet'),
+                      engine='pyarrow', compression='snappy')
     print("[Cell %d] Simulation complete." % cellid)
 
     
     # Debug prints if we had multiple tries
     if tries > 1:
         print(f'[Cell {cellid}] took {tries} tries to get non-zero expression.')
+
+    return cellid, subset
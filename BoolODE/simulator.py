@@ -1,94 +1,115 @@
 import numpy as np
+from numba import njit
 
+@njit(fastmath=True)
 def noise(x,t):
     # Controls noise proportional to
     # square root of activity
     c = 10.#4.
     return (c*np.sqrt(abs(x)))
 
-def deltaW(N, m, h,seed=0):
-    """Generate sequence of Wiener increments for m independent Wiener
-    processes W_j(t) j=0..m-1 for each of N time intervals of length h.    
-    From the sdeint implementation
-
-    :returns:
-        - dW : The [n, j] element has the value W_j((n+1)*h) - W_j(n*h) ( has shape (N, m) )
-    """
-    np.random.seed(seed)
-    return np.random.normal(0.0, h, (N, m))
-
-def eulersde(f,G,y0,tspan,pars,seed=0.,dW=None):
+# Not cached on disk: Model is a new dispatcher for every generated
+# model, so a cached version would never be reused
+@njit(fastmath=True)
+def eulerMaruyama(Model,y0,pars,tspan,seed,checkIndex,threshold):
     """
-    Adapted from sdeint implementation https://github.com/mattja/sdeint/
+    Euler-Maruyama integration of the model, adapted from the sdeint
+    implementation https://github.com/mattja/sdeint/. The Wiener increments
+    are drawn step by step from numba's random number generator, seeded with `seed`.
+    While integrating, checks whether any of the variables in `checkIndex` reaches `threshold`.
+    Once one does, the check is skipped for the remaining steps.
 
-    :param f: function defining ODE model. Should take vector of current state, current time, and list of parameter values as arguments.
-    :type f: function
-    :param pars: List of parameter values
-    :type pars: list
-    :param y0: list of initial values
-    :type y0: list
+    :param Model: numba compiled function defining the ODE model. Should take the vector of current state, current time, the array of parameter values and an output vector for the time derivatives as arguments.
+    :type Model: function
+    :param y0: array of initial values
+    :type y0: ndarray
+    :param pars: Array of parameter values
+    :type pars: ndarray
     :param tspan: Array of timepoints to simulate
     :type tspan: ndarray
     :param seed: Seed to initialize random number generator
-    :type seed: float
+    :type seed: int
+    :param checkIndex: Indices of the variables to compare to threshold
+    :type checkIndex: ndarray
+    :param threshold: Value that at least one of the checked variables should reach
+    :type threshold: float
     :returns:
         - y: Array containing the time course of state variables 
+        - ok: True if a checked variable reached threshold
     """
-    # From sdeint implementation
     N = len(tspan)
     h = (tspan[N-1] - tspan[0])/(N - 1)
-    maxtime = tspan[-1]
-    # allocate space for result
     d = len(y0)
-    y = np.zeros((N+1, d), dtype=type(y0[0]))
-
-    if dW is None:
-        # pre-generate Wiener increments (for d independent Wiener processes):
-        dW = deltaW(N, d, h, seed=seed)
+    np.random.seed(seed)
+    y = np.empty((N, d))
+    dy = np.empty(d)
     y[0] = y0
-    currtime = 0
-    n = 0
-   
-    while currtime < maxtime:
-        tn = currtime
-        yn = y[n]
-        dWn = dW[n,:]
-        y[n+1] = yn + f(yn, tn,pars)*h + np.multiply(G(yn, tn),dWn)
-        # Ensure positive terms
-        for i in range(len(y[n+1])):
-            if y[n+1][i] < 0:
-                y[n+1][i] = yn[i]
-        currtime += h
-        n += 1 
-    return y
+    ok = False
+    for i in checkIndex:
+        if y0[i] >= threshold:
+            ok = True
+    for n in range(N-1):
+        tn = tspan[n]
+        Model(y[n], tn, pars, dy)
+        for i in range(d):
+            dWn = np.random.normal(0.0, h)
+            y[n+1, i] = y[n, i] + dy[i]*h + noise(y[n, i], tn)*dWn
+            # Ensure positive terms
+            if y[n+1, i] < 0:
+                y[n+1, i] = y[n, i]
+        if not ok:
+            for i in checkIndex:
+                if y[n+1, i] >= threshold:
+                    ok = True
+    return y, ok
 
-def simulateModel(Model, y0, parameters,isStochastic, tspan,seed):
-    """Call numerical integration functions, either odeint() from Scipy,
-    or simulator.eulersde() defined in simulator.py. By default, stochastic simulations are
-    carried out using simulator.eulersde.
+def simulateModel(Model, y0, parameters,isStochastic, tspan,seed,funcptr=None,
+                  checkIndex=None, threshold=0.):
+    """Call numerical integration functions, either lsoda() from numbalsoda,
+    or simulator.eulerMaruyama() defined in simulator.py. By default, stochastic simulations are
+    carried out using simulator.eulerMaruyama.
 
-    :param Model: Function defining ODE model
+    :param Model: numba compiled function defining ODE model (ModelRHS in model.py)
     :type Model: function
     :param y0: array of initial values for each state variable
     :type y0: array
-    :param parameters: list of parameter values to be used in simulations
-    :type parameters: list
+    :param parameters: array of parameter values to be used in simulations
+    :type parameters: ndarray
     :param isStochastic: User defined parameter. Default = True, can be turned off to perform ODE simulations.
     :type isStochastic: bool
     :param tspan: Time points to simulate
     :type tspan: ndarray
     :param seed: Seed to initialize random number generator
-    :type seed: float
+    :type seed: int
+    :param funcptr: Address of the model compiled as a numbalsoda cfunc (ModelLSODA in model.py). Required for ODE simulations.
+    :type funcptr: int
+    :param checkIndex: Indices of the variables, at least one of which should reach `threshold` for the simulation to be valid
+    :type checkIndex: ndarray
+    :param threshold: Minimum value that one of the variables in checkIndex should reach
+    :type threshold: float
     :returns: 
         - P: Time course from numerical integration
-    :rtype: ndarray
+        - ok: True if the integration succeeded and one of the checked variables reached threshold
+    :rtype: tuple
 
     """
+    y0 = np.ascontiguousarray(y0, dtype=np.float64)
+    tspan = np.ascontiguousarray(tspan, dtype=np.float64)
+    parameters = np.ascontiguousarray(parameters, dtype=np.float64)
+    if checkIndex is None:
+        checkIndex = np.empty(0, dtype=np.int64)
     if not isStochastic:
-        P = odeint(Model,y0,tspan,args=(parameters,))
+        # numbalsoda is only needed for ODE simulations
+        from numbalsoda import lsoda
+        P, success = lsoda(funcptr, y0, tspan, data=parameters)
+        if not success:
+            print("lsoda failed to integrate the model")
+        ok = success and (len(checkIndex) == 0 or P[:, checkIndex].max() >= threshold)
     else:
-        P = eulersde(Model,noise,y0,tspan,parameters,seed=seed)
-    return(P)
+        P, ok = eulerMaruyama(Model,y0,parameters,tspan,seed,
+                              np.ascontiguousarray(checkIndex, dtype=np.int64),
+                              float(threshold))
+    return(P, ok)
 
 def getInitialCondition(ss, ModelSpec, rnaIndex,
                         proteinIndex,
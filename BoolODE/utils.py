@@ -329,40 +329,24 @@ def sampleTimeSeries(num_timepoints, expnum,\
     sampleDF = pd.DataFrame(sampleDict)
     return(sampleDF)
 
-def sampleCellFromTraj(cellid,
-                       tspan,
-                       P,
-                       varmapper,sampleAt,
-                       genelist, proteinlist,
-                       header,writeProtein=False):
+def readSimulation(path, simulationFormat='csv'):
     """
-    Returns pandas DataFrame with columns corresponding to 
+    Reads a single simulation written by BoolODE, stored
+    as <path>.csv or <path>.parquet depending on simulationFormat.
+    Returns pandas DataFrame with columns corresponding to
     time points and rows corresponding to genes
-    """
-    revvarmapper = {v:k for k,v in varmapper.items()}
-    rnaIndex = [i for i in range(len(varmapper.keys())) if 'x_' in varmapper[i]]
-    sampleDict = {}
-    timepoint = int(header[cellid].split('_')[1])
-    if writeProtein:
-        # Write protein and mRNA to file
-        for ri in varmapper.keys():
-            sampleDict[varmapper[ri]] = {header[cellid]: P[ri][timepoint]}
-    else:
-        # Default, only mRNA
-        if len(proteinlist) == 0:
-            for ri in rnaIndex:
-                sampleDict[varmapper[ri]] = {header[cellid]: P[ri][timepoint]}
-        else:
-            speciesoi = [revvarmapper['p_' + p] for p in proteinlist]
-            speciesoi.extend([revvarmapper['x_' + g] for g in genelist])
-            result = pd.DataFrame(index=pd.Index([varmapper[i] for i\
-                                                  in speciesoi]))
-            for si in speciesoi:
-                sampleDict[varmapper[si]] = {header[cellid]: P[ri][timepoint]}
-
-    sampleDF = pd.DataFrame(sampleDict)
-    return(sampleDF)
 
+    :param path: Path to the simulation file, without extension
+    :type path: str
+    :param simulationFormat: One of ['csv','parquet'], the value of simulation_format used for the simulations
+    :type simulationFormat: str
+    """
+    if simulationFormat == 'csv':
+        return(pd.read_csv(str(path) + '.csv', index_col=0))
+    elif simulationFormat == 'parquet':
+        return(pd.read_parquet(str(path) + '.parquet'))
+    raise ValueError("Cannot read simulations written with simulation_format '"
+                     + str(simulationFormat) + "', use 'csv' or 'parquet'")
 
 def checkValidInputPath(path):
     """
@@ -5,6 +5,9 @@ import os
 import sys
 from pathlib import Path
 from optparse import OptionParser
+# BoolODE is imported from the repository this script belongs to
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from BoolODE import utils
 
 def parseArgs(args):
     parser = OptionParser()
@@ -20,6 +23,9 @@ def parseArgs(args):
     
     parser.add_option('-d', '--nDatasets', type='int',default='1',
                       help='Number of datasets to be generated')        
+
+    parser.add_option('-f', '--simulation-format', type='str',default='csv',
+                      help='Format of the files under /simulations, one of csv or parquet')
     
     (opts, args) = parser.parse_args(args)
 
@@ -35,7 +41,7 @@ def genSamples(opts):
     if opts.nCells > num_experiments:
         print('nCells should be less than num of experiments')
         sys.exit()
-    df = pd.read_csv(opts.input_path + '/simulations/E0.csv',index_col=0)
+    df = utils.readSimulation(opts.input_path + '/simulations/E0', opts.simulation_format)
     maxtime = len(df.columns)
     for did in range(1, opts.nDatasets + 1):
         # example:
@@ -46,7 +52,7 @@ def genSamples(opts):
             os.makedirs(outfpath)
         # Create cell ids
         simids = np.random.choice(range(num_experiments), size=opts.nCells, replace=False)
-        fids = ['E'+ str(sid) + '.csv' for sid in simids]            
+        fids = ['E'+ str(sid) for sid in simids]            
         timepoints = np.random.choice(range(1,maxtime), size=opts.nCells)
         min_t = min(timepoints)
         max_t = max(timepoints)
@@ -56,7 +62,7 @@ def genSamples(opts):
         # to build a sample
         sample = []
         for fid, cid in tqdm(zip(fids, cellids)):
-            df = pd.read_csv( opts.input_path + '/simulations/' + fid, index_col=0)
+            df = utils.readSimulation(opts.input_path + '/simulations/' + fid, opts.simulation_format)
             df.sort_index(inplace=True)
             sample.append(df[cid].to_frame())
         sampledf = pd.concat(sample,axis=1)